@@ -1,7 +1,24 @@
+import hashlib
 import json
 import os
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import boto3
+from botocore.config import Config
+
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    _loads = orjson.loads
+except ImportError:
+    # orjson is bundled by deploy_lambda_eventbridge.sh; fall back to the stdlib if it is missing
+    _dumps = json.dumps
+    _loads = json.loads
 
 STEP_FUNCTION_ARN = os.environ.get("STEP_FUNCTION_ARN")
 DELETE_SUFFIX = os.environ.get("DELETE_SUFFIX", "-deletes.parquet")
@@ -11,6 +28,12 @@ RETRY_DELAY_SECONDS = int(os.environ.get("RETRY_DELAY_SECONDS", "300"))
 LOCK_TTL_SECONDS = int(os.environ.get("LOCK_TTL_SECONDS", "900"))
 CATALOG_NAME = os.environ.get("CATALOG_NAME", "glue_catalog")
 WAREHOUSE_S3 = os.environ.get("WAREHOUSE_S3", "")
+TRANSACT_MAX_ITEMS = 100  # DynamoDB TransactWriteItems limit
+TRANSACT_MAX_ATTEMPTS = 5  # Re-issues of a transaction cancelled only by transient reasons
+# Cancellation reasons that say nothing about the item itself; the write is re-issued
+TRANSIENT_CANCELLATION_CODES = {"TransactionConflict", "ThrottlingError", "ProvisionedThroughputExceeded"}
+SQS_BATCH_MAX = 10  # SQS SendMessageBatch limit
+MAX_WORKERS = 32
 
 # TABLE_MAPPINGS format: "s3_prefix:db.table,s3_prefix2:db2.table2"
 # Example: "federation_demo_db_ryan/customers_iceberg:federation_demo_db_ryan.customers_iceberg"
@@ -27,17 +50,51 @@ ALLOWLIST = {
     for item in os.environ.get("TABLE_ALLOWLIST", "").split(",")
     if item.strip()
 }
+# A key can only belong to an allowlisted table if it starts with "<prefix>/"
+ALLOWLIST_KEY_PREFIXES = tuple(f"{item}/" for item in ALLOWLIST)
+
+# HTTP pool sized above MAX_WORKERS so thread-pool calls don't wait on connections
+CLIENT_CONFIG = Config(
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    connect_timeout=1.0,
+    read_timeout=3.0,
+)
+
+sf = boto3.client("stepfunctions", config=CLIENT_CONFIG)
+ddb = boto3.client("dynamodb", config=CLIENT_CONFIG)
+sqs = boto3.client("sqs", config=CLIENT_CONFIG)
+
+# Created once per container and reused by warm invocations; threads are started lazily
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
-sf = boto3.client("stepfunctions")
-ddb = boto3.client("dynamodb")
-sqs = boto3.client("sqs")
 
+# Warm-up runs inside Lambda's init limit: one attempt, short timeouts
+WARM_CONFIG = Config(retries={"max_attempts": 1}, connect_timeout=0.5, read_timeout=1.0)
 
-def _is_delete_file(key: str) -> bool:
-    return key.endswith(DELETE_SUFFIX)
+
+def _warm_clients() -> None:
+    """Resolve credentials and endpoints during init so the first invocation does not pay for them."""
+    try:
+        boto3.client("dynamodb", config=WARM_CONFIG).describe_table(TableName=LOCK_TABLE)
+    except Exception:
+        pass
+    if QUEUE_URL:
+        try:
+            boto3.client("sqs", config=WARM_CONFIG).get_queue_attributes(
+                QueueUrl=QUEUE_URL, AttributeNames=["QueueArn"]
+            )
+        except Exception:
+            pass
 
 
-def _table_id_from_key(key: str) -> tuple:
+if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+    _warm_clients()
+
+
+# Hot-path config is bound as default arguments (fast locals instead of global lookups)
+def _table_id_from_key(key: str, _mappings: dict = TABLE_MAPPINGS, _catalog: str = CATALOG_NAME) -> tuple:
     """
     Extract table info from S3 key.
     Returns (s3_table_prefix, glue_table_identifier)
@@ -47,178 +104,297 @@ def _table_id_from_key(key: str) -> tuple:
       returns ("federation_demo_db_ryan/customers_iceberg", "glue_catalog.federation_demo_db_ryan.customers_iceberg")
     """
     # Extract S3 prefix (everything before /data/ or /metadata/)
-    s3_prefix = key
-    for marker in ("/data/", "/metadata/"):
-        if marker in key:
-            s3_prefix = key.split(marker)[0]
-            break
-    else:
+    s3_prefix, sep, _ = key.partition("/data/")
+    if not sep:
+        s3_prefix, sep, _ = key.partition("/metadata/")
+    if not sep:
         s3_prefix = key.rsplit("/", 1)[0]
     
     # Look up in explicit mappings first
-    if s3_prefix in TABLE_MAPPINGS:
-        glue_table = f"{CATALOG_NAME}.{TABLE_MAPPINGS[s3_prefix]}"
+    mapped = _mappings.get(s3_prefix)
+    if mapped is not None:
+        glue_table = f"{_catalog}.{mapped}"
     else:
         # Auto-derive: assume S3 path is database/table, convert to catalog.database.table
         # e.g., "federation_demo_db_ryan/customers_iceberg" -> "glue_catalog.federation_demo_db_ryan.customers_iceberg"
-        glue_table = f"{CATALOG_NAME}.{s3_prefix.replace('/', '.')}"
+        glue_table = f"{_catalog}.{s3_prefix.replace('/', '.')}"
     
     return (s3_prefix, glue_table)
 
 
-def _acquire_lock(table_id: str) -> bool:
-    now = int(time.time())
-    lock_until = now + LOCK_TTL_SECONDS
-    try:
-        ddb.put_item(
-            TableName=LOCK_TABLE,
-            Item={
-                "table_id": {"S": table_id},
-                "lock_until": {"N": str(lock_until)},
-            },
-            ConditionExpression="attribute_not_exists(table_id) OR lock_until < :now",
-            ExpressionAttributeValues={":now": {"N": str(now)}},
-        )
-        return True
-    except ddb.exceptions.ConditionalCheckFailedException:
-        return False
+def _chunked(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
-def _is_retry_already_queued(table_id: str) -> bool:
-    """Check if a retry is already queued for this table (stored in DynamoDB)."""
-    now = int(time.time())
-    try:
-        resp = ddb.get_item(
-            TableName=LOCK_TABLE,
-            Key={"table_id": {"S": table_id}},
-            ProjectionExpression="retry_queued_until",
+def _transact_conditional_writes(writes: dict, owner: str) -> tuple:
+    """
+    Apply independent conditional Updates ({key: TransactItem}) in as few calls as possible.
+    Returns (written_keys, {key: old_item}) for keys whose condition failed; anything else raises.
+    A failed row already owned by owner is our own retried write and counts as written.
+    """
+    if len(writes) == 1:
+        (key, item), = writes.items()
+        try:
+            ddb.update_item(**item["Update"])
+            return {key}, {}
+        except ddb.exceptions.ConditionalCheckFailedException as e:
+            old = e.response.get("Item", {})
+            if old.get("o", {}).get("S") == owner:
+                return {key}, {}
+            return set(), {key: old}
+
+    written = set()
+    rejected = {}
+    for chunk in _chunked(list(writes), TRANSACT_MAX_ITEMS):
+        attempts = 0
+        while chunk:
+            try:
+                # The token makes botocore's retries of this exact call idempotent
+                ddb.transact_write_items(
+                    TransactItems=[writes[k] for k in chunk],
+                    ClientRequestToken=str(uuid.uuid4()),
+                )
+                written.update(chunk)
+                break
+            except ddb.exceptions.TransactionCanceledException as e:
+                reasons = e.response.get("CancellationReasons") or []
+                if len(reasons) != len(chunk):
+                    raise
+                remaining = []
+                transient = False
+                for k, r in zip(chunk, reasons):
+                    code = r.get("Code")
+                    if code == "ConditionalCheckFailed":
+                        rejected[k] = r.get("Item", {})
+                    elif code == "None":
+                        remaining.append(k)
+                    elif code in TRANSIENT_CANCELLATION_CODES:
+                        remaining.append(k)
+                        transient = True
+                    else:
+                        raise
+                if not transient and len(remaining) == len(chunk):
+                    raise  # Cancelled without naming any item
+                if transient:
+                    attempts += 1
+                    if attempts >= TRANSACT_MAX_ATTEMPTS:
+                        raise
+                    time.sleep(0.05 * attempts)
+                chunk = remaining
+    return written, rejected
+
+
+# Lock table rows are keyed by table_id. Other attributes use one-letter names to keep
+# requests small: l = lock_until (epoch seconds, TTL attribute), r = retry_queued_until,
+# o = owner (the invocation that last wrote the row).
+# Rows written before the rename still carry lock_until / retry_queued_until, so those
+# are honoured in every condition and dropped when the lock is next claimed.
+def _acquire_locks(table_ids, now_str: str, lock_until_str: str, owner: str) -> tuple:
+    """
+    Acquire locks for many tables in one round-trip.
+    Returns (locked_table_ids, {table_id: current_row}) for the tables already locked,
+    so callers can see an existing retry marker without reading the row again.
+    Claiming a lock also clears any retry marker on the same row.
+    """
+    return _transact_conditional_writes({
+        table_id: {
+            "Update": {
+                "TableName": LOCK_TABLE,
+                "Key": {"table_id": {"S": table_id}},
+                "UpdateExpression": "SET l = :lu, o = :o REMOVE r, lock_until, retry_queued_until",
+                "ConditionExpression": (
+                    "(attribute_not_exists(l) OR l < :now)"
+                    " AND (attribute_not_exists(lock_until) OR lock_until < :now)"
+                ),
+                "ExpressionAttributeValues": {
+                    ":lu": {"N": lock_until_str},
+                    ":now": {"N": now_str},
+                    ":o": {"S": owner},
+                },
+                "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+            }
+        }
+        for table_id in table_ids
+    }, owner)
+
+
+def _mark_retries_queued(table_ids, now_str: str, retry_until_str: str, owned: set, owner: str) -> tuple:
+    """
+    Mark that a retry is queued for many tables in one round-trip.
+    Returns (marked_table_ids, already_queued_table_ids).
+    Tables in owned came from the queued retry itself, so their marker is refreshed unconditionally.
+    """
+    writes = {}
+    for table_id in table_ids:
+        update = {
+            "TableName": LOCK_TABLE,
+            "Key": {"table_id": {"S": table_id}},
+            "UpdateExpression": "SET r = :until, o = :o",
+            "ExpressionAttributeValues": {
+                ":until": {"N": retry_until_str},
+                ":o": {"S": owner},
+            },
+        }
+        if table_id not in owned:
+            update["ConditionExpression"] = (
+                "(attribute_not_exists(r) OR r < :now)"
+                " AND (attribute_not_exists(retry_queued_until) OR retry_queued_until < :now)"
+            )
+            update["ExpressionAttributeValues"][":now"] = {"N": now_str}
+            update["ReturnValuesOnConditionCheckFailure"] = "ALL_OLD"
+        writes[table_id] = {"Update": update}
+    marked, rejected = _transact_conditional_writes(writes, owner)
+    return marked, set(rejected)
+
+
+def _retry_pending(row: dict, now: int) -> bool:
+    """True if a lock table row still has an unexpired retry marker."""
+    marker = row.get("r") or row.get("retry_queued_until") or {}
+    return int(marker.get("N", "0")) >= now
+
+
+def _send_retries(retries: list) -> None:
+    """Send one delayed SQS retry per (s3_prefix, glue_table, bucket), 10 messages per call."""
+    for chunk in _chunked(retries, SQS_BATCH_MAX):
+        resp = sqs.send_message_batch(
+            QueueUrl=QUEUE_URL,
+            Entries=[
+                {
+                    "Id": str(i),
+                    "MessageBody": _dumps({
+                        "s3_prefix": s3_prefix,
+                        "glue_table": glue_table,
+                        "bucket": bucket
+                    }),
+                    "DelaySeconds": min(RETRY_DELAY_SECONDS, 900),  # SQS max is 900
+                }
+                for i, (s3_prefix, glue_table, bucket) in enumerate(chunk)
+            ],
         )
-        item = resp.get("Item", {})
-        retry_until = int(item.get("retry_queued_until", {}).get("N", "0"))
-        return retry_until > now
-    except Exception:
-        return False
+        if resp.get("Failed"):
+            raise RuntimeError(f"Failed to queue retries: {resp['Failed']}")
 
 
-def _mark_retry_queued(table_id: str) -> bool:
-    """Mark that a retry is queued. Returns True if successfully marked (no existing retry)."""
-    now = int(time.time())
-    retry_until = now + RETRY_DELAY_SECONDS + 60  # Add buffer
-    try:
-        ddb.update_item(
-            TableName=LOCK_TABLE,
-            Key={"table_id": {"S": table_id}},
-            UpdateExpression="SET retry_queued_until = :until",
-            ConditionExpression="attribute_not_exists(retry_queued_until) OR retry_queued_until < :now",
-            ExpressionAttributeValues={
-                ":until": {"N": str(retry_until)},
-                ":now": {"N": str(now)},
-            },
-        )
-        return True
-    except ddb.exceptions.ConditionalCheckFailedException:
-        return False  # Retry already queued
+# Step Function input has a fixed schema: each value is JSON-encoded on its own
+# (so quotes/backslashes stay escaped) and dropped into a preformatted object
+SF_INPUT_TEMPLATE = '{"table_id":%s,"glue_table":%s,"warehouse_s3":%s}'
+WAREHOUSE_S3_JSON = _dumps(WAREHOUSE_S3) if WAREHOUSE_S3 else None
 
 
-def _clear_retry_marker(table_id: str) -> None:
-    """Clear the retry marker after processing."""
+def _start_compaction(s3_prefix: str, glue_table: str, bucket: str, lock_until_str: str) -> None:
+    # One execution name per lock, so a retried StartExecution cannot start a second run
+    name = "compact-" + hashlib.sha256(f"{s3_prefix}@{lock_until_str}".encode()).hexdigest()
+    # Pass glue_table and warehouse to Step Function for dynamic compaction
     try:
-        ddb.update_item(
-            TableName=LOCK_TABLE,
-            Key={"table_id": {"S": table_id}},
-            UpdateExpression="REMOVE retry_queued_until",
+        sf.start_execution(
+            stateMachineArn=STEP_FUNCTION_ARN,
+            name=name,
+            input=SF_INPUT_TEMPLATE % (
+                _dumps(s3_prefix),
+                _dumps(glue_table),
+                WAREHOUSE_S3_JSON or _dumps(f"s3://{bucket}/"),
+            ),
         )
-    except Exception:
-        pass
+    except sf.exceptions.ExecutionAlreadyExists:
+        pass  # Started by an earlier attempt of this call
+
+
+def _wanted_key(key: str, _suffix: str = DELETE_SUFFIX, _prefixes: tuple = ALLOWLIST_KEY_PREFIXES) -> bool:
+    """Delete file that can belong to an allowlisted table (exact prefix is checked after parsing)."""
+    return key.endswith(_suffix) and (not _prefixes or key.startswith(_prefixes))
+
+
+def _extract_sqs(records):
+    """SQS retry messages (or raw S3 keys sent through the retry queue)."""
+    for record in records:
+        body = _loads(record["body"])
+        if "glue_table" in body:
+            # New format with glue_table
+            if not ALLOWLIST or body["s3_prefix"] in ALLOWLIST:
+                yield (body["bucket"], None, body["s3_prefix"], body["glue_table"], True)
+        elif "table_id" in body:
+            # Old format (backwards compatibility)
+            if not ALLOWLIST or body["table_id"] in ALLOWLIST:
+                yield (body["bucket"], None, body["table_id"], None, True)
+        elif body.get("key") and _wanted_key(body["key"]):
+            yield (body["bucket"], body["key"], None, None, False)
+
+
+def _extract_eventbridge(records):
+    """EventBridge "Object Created" events."""
+    for record in records:
+        detail = record.get("detail", {})
+        if "object" in detail and "bucket" in detail and _wanted_key(detail["object"]["key"]):
+            yield (detail["bucket"]["name"], detail["object"]["key"], None, None, False)
 
 
-def _enqueue_retry_for_table(s3_prefix: str, glue_table: str, bucket: str) -> bool:
-    """Queue ONE retry per table. Returns True if queued, False if already queued."""
-    if not QUEUE_URL:
-        return False
-    
-    # Check/set marker in DynamoDB to ensure only 1 retry per table
-    if not _mark_retry_queued(s3_prefix):
-        return False  # Retry already queued, skip
-    
-    sqs.send_message(
-        QueueUrl=QUEUE_URL,
-        MessageBody=json.dumps({
-            "s3_prefix": s3_prefix,
-            "glue_table": glue_table,
-            "bucket": bucket
-        }),
-        DelaySeconds=min(RETRY_DELAY_SECONDS, 900),  # SQS max is 900
-    )
-    return True
+def _extract_s3(records):
+    """S3 bucket notifications."""
+    for record in records:
+        s3 = record.get("s3")
+        if s3 and _wanted_key(s3["object"]["key"]):
+            yield (s3["bucket"]["name"], s3["object"]["key"], None, None, False)
 
 
 def _extract_events(event):
     """
     Parse incoming events from EventBridge, S3 notifications, or SQS retries.
-    Returns list of tuples: (bucket, s3_key_or_none, s3_prefix_or_none, glue_table_or_none, is_retry)
+    Yields tuples: (bucket, s3_key_or_none, s3_prefix_or_none, glue_table_or_none, is_retry)
+    Keys that are not delete files and tables outside TABLE_ALLOWLIST are dropped here.
     """
     records = event.get("Records")
-    if records is None and "detail" in event:
-        records = [event]
-
-    events = []
-    for record in records or []:
-        # SQS retry message
-        if record.get("eventSource") == "aws:sqs":
-            body = json.loads(record["body"])
-            if "glue_table" in body:
-                # New format with glue_table
-                events.append((body["bucket"], None, body["s3_prefix"], body["glue_table"], True))
-            elif "table_id" in body:
-                # Old format (backwards compatibility)
-                events.append((body["bucket"], None, body["table_id"], None, True))
-            else:
-                events.append((body["bucket"], body["key"], None, None, False))
-            continue
-
-        # EventBridge detail
-        detail = record.get("detail", {})
-        if "object" in detail and "bucket" in detail:
-            events.append((detail["bucket"]["name"], detail["object"]["key"], None, None, False))
-            continue
+    if records is None:
+        return _extract_eventbridge([event]) if "detail" in event else iter(())
+    if not records:
+        return iter(())
 
-        # S3 notification
-        s3 = record.get("s3")
-        if s3:
-            events.append((s3["bucket"]["name"], s3["object"]["key"], None, None, False))
-
-    return events
+    # Records in one invocation share a source, so the first record picks the extractor
+    first = records[0]
+    if first.get("eventSource") == "aws:sqs":
+        return _extract_sqs(records)
+    if "s3" in first:
+        return _extract_s3(records)
+    return _extract_eventbridge(records)
 
 
 def handler(event, context):
+    # Timestamps are computed once per invocation and shared by every DynamoDB write
+    now = int(time.time())
+    now_str = str(now)
+    lock_until_str = str(now + LOCK_TTL_SECONDS)
+    retry_until_str = str(now + RETRY_DELAY_SECONDS + 60)  # Add buffer
+    owner = uuid.uuid4().hex
+
     # Deduplicate by s3_prefix - only trigger ONE compaction per table
     # tables_to_compact: {s3_prefix: (glue_table, bucket)}
     tables_to_compact = {}
+    retry_prefixes = set()
+    # Delete files of a table share a few directories, so each directory is parsed once
+    # parsed_dirs: {key_dir: (s3_prefix, glue_table)}
+    parsed_dirs = {}
     is_retry = False
 
     for bucket, s3_key, s3_prefix, glue_table, is_retry_msg in _extract_events(event):
         if is_retry_msg:
             is_retry = True
-            if glue_table:
-                # New retry format with glue_table
-                _clear_retry_marker(s3_prefix)
-            else:
+            if not glue_table:
                 # Old format - derive glue_table from s3_prefix
                 s3_prefix, glue_table = _table_id_from_key(s3_prefix + "/data/dummy")
-                _clear_retry_marker(s3_prefix)
+            # The retry marker is cleared when the lock is acquired
+            retry_prefixes.add(s3_prefix)
         else:
             # This is a delete file event from S3
-            if not s3_key or not _is_delete_file(s3_key):
+            key_dir = s3_key[:s3_key.rfind("/") + 1] or s3_key
+            table = parsed_dirs.get(key_dir)
+            if table is None:
+                table = parsed_dirs[key_dir] = _table_id_from_key(key_dir)
+            s3_prefix, glue_table = table
+            if ALLOWLIST and s3_prefix not in ALLOWLIST:
                 continue
-            s3_prefix, glue_table = _table_id_from_key(s3_key)
-        
-        if ALLOWLIST and s3_prefix not in ALLOWLIST:
-            continue
-        
+
         # Only process each table once per invocation
-        if s3_prefix not in tables_to_compact:
-            tables_to_compact[s3_prefix] = (glue_table, bucket)
+        tables_to_compact.setdefault(s3_prefix, (glue_table, bucket))
 
     if not tables_to_compact:
         return {"status": "no-op", "matched": 0}
@@ -226,28 +402,45 @@ def handler(event, context):
     if not STEP_FUNCTION_ARN:
         raise RuntimeError("STEP_FUNCTION_ARN is not set")
 
-    triggered = 0
-    retried = 0
-    skipped = 0
+    locked, lock_rows = _acquire_locks(tables_to_compact, now_str, lock_until_str, owner)
 
+    to_start = []
+    to_retry = []
+    skipped = 0
     for s3_prefix, (glue_table, bucket) in tables_to_compact.items():
-        if not _acquire_lock(s3_prefix):
-            if _enqueue_retry_for_table(s3_prefix, glue_table, bucket):
-                retried += 1
-            else:
-                skipped += 1  # Retry already queued, skip
-            continue
-
-        # Pass glue_table and warehouse to Step Function for dynamic compaction
-        sf.start_execution(
-            stateMachineArn=STEP_FUNCTION_ARN,
-            input=json.dumps({
-                "table_id": s3_prefix,
-                "glue_table": glue_table,
-                "warehouse_s3": WAREHOUSE_S3 or f"s3://{bucket}/",
-            }),
-        )
-        triggered += 1
+        if s3_prefix in locked:
+            to_start.append((s3_prefix, glue_table, bucket))
+        elif s3_prefix not in retry_prefixes and _retry_pending(lock_rows.get(s3_prefix, {}), now):
+            skipped += 1  # Retry already queued, skip
+        else:
+            to_retry.append((s3_prefix, glue_table, bucket))
+
+    started = [executor.submit(_start_compaction, *table, lock_until_str) for table in to_start]
+    try:
+        # Queue ONE retry per table: the DynamoDB marker skips tables that already have one
+        queued = []
+        if QUEUE_URL and to_retry:
+            marked, already_queued = _mark_retries_queued(
+                [s3_prefix for s3_prefix, _, _ in to_retry],
+                now_str,
+                retry_until_str,
+                retry_prefixes,
+                owner,
+            )
+            queued = [table for table in to_retry if table[0] in marked]
+            _send_retries(queued)
+            skipped += len(already_queued)  # Marker was set by a concurrent invocation
+        elif to_retry:
+            skipped += len(to_retry)  # No retry queue configured
+    finally:
+        # Don't let the invocation end (and the container freeze) with starts in flight
+        wait(started)
+
+    for f in started:
+        f.result()
+
+    triggered = len(to_start)
+    retried = len(queued)
 
     return {
         "status": "triggered" if triggered > 0 else ("queued" if retried > 0 else "skipped"),
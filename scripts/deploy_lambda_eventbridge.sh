@@ -85,7 +85,7 @@ if [ "$TABLE_EXISTS" = "None" ] || [ -z "$TABLE_EXISTS" ]; then
   aws dynamodb update-time-to-live \
     --region "$AWS_REGION" \
     --table-name "$LOCK_TABLE_NAME" \
-    --time-to-live-specification "Enabled=true,AttributeName=lock_until" >/dev/null
+    --time-to-live-specification "Enabled=true,AttributeName=l" >/dev/null
 fi
 
 # 2c) Create SQS queue for retries if needed
@@ -121,7 +121,8 @@ cat > "$TMPDIR/lambda_ddb_sqs_policy.json" <<JSON
         "dynamodb:PutItem",
         "dynamodb:GetItem",
         "dynamodb:UpdateItem",
-        "dynamodb:DeleteItem"
+        "dynamodb:DeleteItem",
+        "dynamodb:DescribeTable"
       ],
       "Resource": "arn:aws:dynamodb:${AWS_REGION}:*:table/${LOCK_TABLE_NAME}"
     },
@@ -139,9 +140,17 @@ aws iam put-role-policy \
   --policy-name iceberg-delete-detector-ddb-sqs \
   --policy-document file://"$TMPDIR/lambda_ddb_sqs_policy.json"
 
-# 3) Package Lambda
+# 3) Package Lambda (bundles orjson for faster JSON; the function falls back to json without it)
 cp "$PROJECT_ROOT/scripts/lambda_detect_delete.py" "$TMPDIR/lambda_function.py"
+rm -rf "$TMPDIR/lambda.zip" "$TMPDIR/lambda_deps"
 ( cd "$TMPDIR" && zip -q lambda.zip lambda_function.py )
+if python3 -m pip install --quiet --target "$TMPDIR/lambda_deps" \
+    --platform manylinux2014_x86_64 --implementation cp --python-version 3.11 \
+    --only-binary=:all: orjson; then
+  ( cd "$TMPDIR/lambda_deps" && zip -qr ../lambda.zip . )
+else
+  echo "WARNING: could not download orjson, deploying with stdlib json" >&2
+fi
 
 # 4) Create or update Lambda function
 FUNCTION_ARN=$(aws lambda get-function --function-name "$LAMBDA_FUNCTION_NAME" \
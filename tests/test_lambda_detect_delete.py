@@ -0,0 +1,121 @@
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+from botocore.stub import ANY, Stubber
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+
+_spec = importlib.util.spec_from_file_location(
+    "lambda_detect_delete",
+    Path(__file__).resolve().parents[1] / "scripts" / "lambda_detect_delete.py",
+)
+lambda_detect_delete = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(lambda_detect_delete)
+
+OWNER = "owner-1"
+
+
+def _write(table_id: str) -> dict:
+    return {
+        "Update": {
+            "TableName": "locks",
+            "Key": {"table_id": {"S": table_id}},
+            "UpdateExpression": "SET l = :lu, o = :o",
+            "ConditionExpression": "attribute_not_exists(l) OR l < :now",
+            "ExpressionAttributeValues": {
+                ":lu": {"N": "200"},
+                ":now": {"N": "100"},
+                ":o": {"S": OWNER},
+            },
+            "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+        }
+    }
+
+
+def _cancel(stubber: Stubber, codes: list, items: dict = None) -> None:
+    items = items or {}
+    reasons = []
+    for i, code in enumerate(codes):
+        reason = {"Code": code}
+        if i in items:
+            reason["Item"] = items[i]
+        reasons.append(reason)
+    stubber.add_client_error(
+        "transact_write_items",
+        service_error_code="TransactionCanceledException",
+        modeled_fields={"CancellationReasons": reasons},
+        expected_params={"TransactItems": ANY, "ClientRequestToken": ANY},
+    )
+
+
+@pytest.fixture
+def stubber(monkeypatch):
+    monkeypatch.setattr(lambda_detect_delete.time, "sleep", lambda _: None)
+    with Stubber(lambda_detect_delete.ddb) as stub:
+        yield stub
+        stub.assert_no_pending_responses()
+
+
+def test_partial_conditional_failure_reissues_the_rest(stubber):
+    writes = {t: _write(t) for t in ("a", "b", "c")}
+    held = {"table_id": {"S": "b"}, "l": {"N": "999"}}
+    _cancel(stubber, ["None", "ConditionalCheckFailed", "None"], {1: held})
+    stubber.add_response(
+        "transact_write_items",
+        {},
+        {"TransactItems": [writes["a"], writes["c"]], "ClientRequestToken": ANY},
+    )
+
+    written, rejected = lambda_detect_delete._transact_conditional_writes(writes, OWNER)
+
+    assert written == {"a", "c"}
+    assert rejected == {"b": held}
+
+
+def test_transient_reasons_raise_after_max_attempts(stubber):
+    writes = {t: _write(t) for t in ("a", "b")}
+    for _ in range(lambda_detect_delete.TRANSACT_MAX_ATTEMPTS):
+        _cancel(stubber, ["None", "TransactionConflict"])
+
+    with pytest.raises(lambda_detect_delete.ddb.exceptions.TransactionCanceledException):
+        lambda_detect_delete._transact_conditional_writes(writes, OWNER)
+
+
+def test_unknown_reason_raises(stubber):
+    writes = {t: _write(t) for t in ("a", "b")}
+    _cancel(stubber, ["ValidationError", "None"])
+
+    with pytest.raises(lambda_detect_delete.ddb.exceptions.TransactionCanceledException):
+        lambda_detect_delete._transact_conditional_writes(writes, OWNER)
+
+
+def test_single_write_returns_all_old_row(stubber):
+    held = {"table_id": {"S": "a"}, "l": {"N": "999"}, "r": {"N": "500"}, "o": {"S": "other"}}
+    stubber.add_client_error(
+        "update_item",
+        service_error_code="ConditionalCheckFailedException",
+        modeled_fields={"Item": held},
+        expected_params=_write("a")["Update"],
+    )
+
+    written, rejected = lambda_detect_delete._transact_conditional_writes({"a": _write("a")}, OWNER)
+
+    assert written == set()
+    assert rejected == {"a": held}
+
+
+def test_single_write_seeing_own_row_counts_as_written(stubber):
+    own = {"table_id": {"S": "a"}, "l": {"N": "200"}, "o": {"S": OWNER}}
+    stubber.add_client_error(
+        "update_item",
+        service_error_code="ConditionalCheckFailedException",
+        modeled_fields={"Item": own},
+        expected_params=_write("a")["Update"],
+    )
+
+    written, rejected = lambda_detect_delete._transact_conditional_writes({"a": _write("a")}, OWNER)
+
+    assert written == {"a"}
+    assert rejected == {}